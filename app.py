@@ -2,30 +2,184 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+import hashlib
 import json
+import os
+import re
 
 # =============================================================================
 # CONFIG
 # =============================================================================
 st.set_page_config(page_title="Анализ успеваемости", page_icon="📊", layout="wide")
 OUTCOME = "Итоговый балл"
+# Maps Russian names from DataFrame to English names in GeoJSON properties
+REGION_MAP = {
+    'Акмолинская область': 'Akmola',
+    'Актюбинская область': 'Aktobe',
+    'Алматинская область': 'Almaty',
+    'г.Алматы': 'Almaty (city)',
+    'Атырауская область': 'Atyrau',
+    'Восточно-Казахстанская область': 'East Kazakhstan',
+    'Жамбылская область': 'Jambyl',
+    'Западно-Казахстанская область': 'West Kazakhstan',
+    'Карагандинская область': 'Karaganda',
+    'Костанайская область': 'Kostanay',
+    'Кызылординская область': 'Kyzylorda',
+    'Мангистауская область': 'Mangystau',
+    'Павлодарская область': 'Pavlodar',
+    'Северо-Казахстанская область': 'North Kazakhstan',
+    'Туркестанская область': 'Turkestan',
+    'г.Астана': 'Astana',
+    'г.Шымкент': 'Shymkent (city)',
+    'область Жетісу':'Jetisu',
+    'область Абай':'Abai',
+    'область Ұлытау':'Ulytau',
+}
+# Columns read by the pages; everything else is dropped right after loading
+CATEGORICAL_COLS = ["Область", "Район", "Пол", "Возрастная группа", "Категория", "Должность", "Предмет", "Тип школы"]
+USED_COLS = [OUTCOME] + CATEGORICAL_COLS
 
-@st.cache_data
+def age_group_order(labels):
+    # Order bins such as '<25', '25-30', ..., '>60' by their lower bound.
+    # Only the distinct labels are parsed, never the full column.
+    def lower_bound(label):
+        match = re.search(r"\d+", label)
+        if match is None:
+            return float("inf")
+        bound = int(match.group())
+        if label.startswith("<"):
+            return bound - 0.5
+        if label.startswith(">"):
+            return bound + 0.5
+        return bound
+    return sorted(labels, key=lower_bound)
+
+# One shared, read-only frame for all sessions: cache_resource skips the
+# pickle round-trip cache_data makes on every rerun. Never mutate it.
+@st.cache_resource
 def load_data(path="df.xlsx"):
+    # Parsing Excel is slow, so keep a Parquet copy under .cache/, keyed on a
+    # hash of the workbook's bytes so that any edit to it invalidates the copy.
+    # The copy holds only USED_COLS, so the column list is part of the key too.
     try:
-        return pd.read_excel(path)
+        with open(path, "rb") as f:
+            # usedforsecurity=False keeps md5 available on FIPS-enabled hosts
+            digest = hashlib.md5(f.read() + json.dumps(USED_COLS).encode(), usedforsecurity=False).hexdigest()[:12]
     except FileNotFoundError:
         st.error(f"Файл {path} не найден.")
         return pd.DataFrame()
+    stem = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(".cache", f"{stem}-{digest}.parquet")
+    df = None
+    if os.path.exists(cache_path):
+        try:
+            df = pd.read_parquet(cache_path, engine="pyarrow")
+        except (OSError, ValueError):
+            pass  # unreadable copy: parse the workbook again and rewrite it
+    if df is None:
+        # calamine is a native parser, several times faster than openpyxl; the
+        # callable usecols skips unused columns and tolerates missing ones
+        df = pd.read_excel(path, engine="calamine", usecols=lambda col: col in USED_COLS)
+        # Write to a temporary file and rename it into place, so an interrupted
+        # write never leaves a truncated copy under the final name
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(".cache", exist_ok=True)
+            df.to_parquet(tmp_path, engine="pyarrow", compression="zstd", index=False)
+            os.replace(tmp_path, cache_path)
+            # Copies made from earlier versions of the workbook are never read again
+            stale = re.compile(re.escape(stem) + r"-[0-9a-f]{12}\.parquet")
+            for name in os.listdir(".cache"):
+                if stale.fullmatch(name) and name != os.path.basename(cache_path):
+                    os.remove(os.path.join(".cache", name))
+        except OSError:
+            # read-only deployment or full disk: fall back to parsing Excel each cold start
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    if OUTCOME in df.columns:
+        # Scores are small integers, float32 holds them exactly at half the width
+        df[OUTCOME] = pd.to_numeric(df[OUTCOME], errors="coerce").astype("float32")
+
+    # Low-cardinality text columns become categoricals: filters and groupbys
+    # then work on integer codes instead of hashing Python strings.
+    for col in CATEGORICAL_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    # Age groups are ordered once here so every page and filter inherits it
+    if "Возрастная группа" in df.columns:
+        age_groups = df["Возрастная группа"]
+        df["Возрастная группа"] = age_groups.cat.set_categories(
+            age_group_order(age_groups.cat.categories), ordered=True
+        )
+    return df
+
+def simplify_ring(ring, precision):
+    # Snap a polygon ring to a coarser grid and drop the points that collapse
+    # onto their predecessor. Neighbouring regions share border points, so
+    # they snap identically and stay seamless. Rings that would degenerate
+    # (fewer than 4 points) are kept as they are.
+    snapped = []
+    for lon, lat in ring:
+        point = [round(lon, precision), round(lat, precision)]
+        if not snapped or snapped[-1] != point:
+            snapped.append(point)
+    return snapped if len(snapped) >= 4 else ring
+
+def feature_polygons(feature):
+    # Polygons of a GeoJSON feature as a list, whether it is a Polygon or a
+    # MultiPolygon; each polygon is a list of rings, the outer ring first.
+    geometry = feature["geometry"]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    return [geometry["coordinates"]]
+
+@st.cache_resource
+def load_geojson(path="kz.json", precision=2):
+    # Parsed once per process and shared by every session. Only the region
+    # name is used to match features, so the other properties are dropped,
+    # and the outlines are snapped to ~1 km (0.01°), far below what a
+    # country-level map can show, before the geometry goes to the browser.
+    with open(path, "r", encoding="utf-8") as f:
+        geojson = json.load(f)
+    for feature in geojson["features"]:
+        feature["properties"] = {"name": feature["properties"]["name"]}
+        for polygon in feature_polygons(feature):
+            polygon[:] = [simplify_ring(ring, precision) for ring in polygon]
+    return geojson
+
+def map_view(geojson, names, width=700, height=400):
+    # Centre and zoom that frame the features named in `names`, as
+    # fitbounds="locations" did on the old geo map. At zoom z a Web-Mercator
+    # map is 256 * 2**z pixels wide, so the zoom follows from the bounding
+    # box and a typical chart size (the browser's actual size is unknown here).
+    lons, lats = [], []
+    for feature in geojson["features"]:
+        if feature["properties"]["name"] not in names:
+            continue
+        for polygon in feature_polygons(feature):
+            for lon, lat in polygon[0]:  # the outer ring bounds the polygon
+                lons.append(lon)
+                lats.append(lat)
+    if not lons:
+        return {"lat": 48, "lon": 67}, 3
+    west, east, south, north = min(lons), max(lons), min(lats), max(lats)
+    y_south, y_north = (np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) for lat in (south, north))
+    zoom = min(
+        np.log2(width * 360 / (256 * max(east - west, 1e-6))),
+        np.log2(height * 2 * np.pi / (256 * max(y_north - y_south, 1e-6))),
+    )
+    center_lat = np.degrees(2 * np.arctan(np.exp((y_south + y_north) / 2)) - np.pi / 2)
+    # Back off a little so the outlines don't touch the chart edges
+    return {"lat": float(center_lat), "lon": (west + east) / 2}, float(min(zoom - 0.3, 8))
 
 df = load_data()
 if df.empty or OUTCOME not in df.columns:
     st.stop()
 
-df[OUTCOME] = pd.to_numeric(df[OUTCOME], errors="coerce")
-
 # =============================================================================
 # SIDEBAR: NAVIGATION & FILTERS
 # =============================================================================
@@ -33,33 +187,290 @@ st.sidebar.title("Навигация")
 page = st.sidebar.radio("Выберите страницу", ["Основной анализ", "Детальный анализ", "Карта"])
 
 st.sidebar.title("Фильтры")
-df_filtered = df.copy()
+
+def apply_filters(df, filters):
+    # With no filters the shared, read-only frame is handed back as is rather
+    # than through st.cache_data, which would keep and unpickle a copy of it.
+    return df if not filters else filter_rows(df, filters)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def filter_rows(_df, filters):
+    # `filters` is a tuple of (column, selected values) pairs so Streamlit can
+    # key the cache on it; the base frame never changes within a session.
+    # All conditions are AND-ed into one mask so the frame is sliced once.
+    # Each entry is a filtered frame, so only the recent selections are kept.
+    mask = np.ones(len(_df), dtype=bool)
+    for col, selected in filters:
+        values = _df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Look each row's category code up in a per-category table of
+            # selected flags; the extra trailing slot catches code -1 (NaN).
+            codes = values.cat.categories.get_indexer(list(selected))
+            is_selected = np.zeros(len(values.cat.categories) + 1, dtype=bool)
+            is_selected[codes[codes >= 0]] = True
+            mask &= is_selected[values.cat.codes.to_numpy()]
+        else:
+            mask &= values.isin(selected).to_numpy()
+    return _df[mask]
+
+@st.cache_data(show_spinner=False)
+def filter_options(_df, col, filters=()):
+    # Options of a cascading filter depend only on the upstream selections.
+    values = apply_filters(_df, filters)[col]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Categories are already sorted; keep those present in the selection
+        codes = np.unique(values.cat.codes.to_numpy())
+        return values.cat.categories[codes[codes >= 0]].tolist()
+    return sorted(values.dropna().unique())
+
+@st.cache_data(show_spinner=False)
+def outcome_summary(_df, filters):
+    # Record count, mean and median score of the current selection. np.median
+    # selects the middle value with a partition instead of a full sort.
+    filtered = apply_filters(_df, filters)
+    scores = filtered[OUTCOME].to_numpy()
+    scores = scores[~np.isnan(scores)]
+    if scores.size == 0:
+        return len(filtered), np.nan, np.nan
+    return len(filtered), scores.mean(dtype="float64"), np.median(scores)
+
+@st.cache_data(show_spinner=False)
+def agg_by(_df, filters, by):
+    # Mean score and row count per combination of the `by` columns, shared by
+    # every chart that breaks the current selection down the same way. The
+    # category codes of the key columns are folded into one flat group id,
+    # so np.bincount yields every group's sum and size in one C loop; rows
+    # with a missing key (code -1) are left out, as groupby would.
+    filtered = apply_filters(_df, filters)
+    keys = [filtered[col].astype("category") for col in by]
+    key_codes = [key.cat.codes.to_numpy() for key in keys]
+    shape = tuple(len(key.cat.categories) for key in keys)
+    has_key = np.ones(len(filtered), dtype=bool)
+    for codes in key_codes:
+        has_key &= codes >= 0
+    group_ids = np.ravel_multi_index([codes[has_key] for codes in key_codes], shape)
+    scores = filtered[OUTCOME].to_numpy()[has_key]
+    has_score = ~np.isnan(scores)
+    n_groups = int(np.prod(shape))
+    sizes = np.bincount(group_ids, minlength=n_groups)
+    sums = np.bincount(group_ids[has_score], weights=scores[has_score], minlength=n_groups)
+    n_scores = np.bincount(group_ids[has_score], minlength=n_groups)
+    observed = np.flatnonzero(sizes)
+    with np.errstate(invalid="ignore"):
+        avg_scores = sums[observed] / n_scores[observed]
+    result = {
+        col: pd.Categorical.from_codes(codes, dtype=key.dtype)
+        for col, key, codes in zip(by, keys, np.unravel_index(observed, shape))
+    }
+    result['avg_score'] = avg_scores
+    result['count'] = sizes[observed].astype("int32")
+    return pd.DataFrame(result)
+
+@st.cache_data(show_spinner=False)
+def box_stats(_df, filters, col):
+    # Quartiles and whisker ends of the score per value of `col`, so a box
+    # plot needs five numbers per group instead of every row of the selection.
+    # Quartiles use the "hazen" method, i.e. Plotly's default "linear"
+    # quartilemethod, and whiskers stop at the furthest score within 1.5 IQR
+    # of the box, so the boxes match what Plotly computed from raw data.
+    # Scores beyond the whiskers are kept as each group's distinct outlier
+    # values, so they are still drawn as points. Groups come out in category
+    # order (age groups in age order).
+    filtered = apply_filters(_df, filters)
+    has_score = filtered[OUTCOME].notna()
+    scores = filtered.loc[has_score, OUTCOME]
+    keys = filtered.loc[has_score, col]
+    stats = scores.groupby(keys, observed=True).agg(
+        q1=lambda s: np.quantile(s.to_numpy(), 0.25, method="hazen"),
+        median="median",
+        q3=lambda s: np.quantile(s.to_numpy(), 0.75, method="hazen"),
+    )
+    iqr = stats['q3'] - stats['q1']
+    low = (stats['q1'] - 1.5 * iqr).reindex(keys).to_numpy()
+    high = (stats['q3'] + 1.5 * iqr).reindex(keys).to_numpy()
+    within = (scores.to_numpy() >= low) & (scores.to_numpy() <= high)
+    fenced = scores.where(within).groupby(keys, observed=True)
+    stats['lowerfence'] = fenced.min()
+    stats['upperfence'] = fenced.max()
+    outliers = scores[~within].groupby(keys[~within], observed=True).unique()
+    stats['outliers'] = [
+        np.sort(outliers[key]).tolist() if key in outliers.index else []
+        for key in stats.index
+    ]
+    return stats.rename_axis(col).reset_index()
+
+def bar_labels(agg):
+    # "mean / count" bar labels for an agg_by() result, built in one pass over
+    # plain arrays; rows without data (count is NaN after a merge) get none.
+    return [
+        f"Ср. балл: {avg:.2f}<br>Кол-во: {int(cnt)}" if has_rows else ""
+        for avg, cnt, has_rows in zip(
+            agg['avg_score'].to_numpy(), agg['count'].to_numpy(), agg['count'].notna().to_numpy()
+        )
+    ]
+
+def score_bar(agg, cat_col, title, value_title, orientation="v", text=None, marker=None, value_col='avg_score'):
+    # Bar chart of agg[value_col] per `cat_col`, built straight from NumPy
+    # arrays: the inputs are small aggregates, so px.bar's DataFrame
+    # processing would be pure overhead. Not cached: unpickling a figure
+    # re-validates every trace, which costs more than building it. Scores
+    # keep full precision; hover text rounds them to two decimals.
+    categories = agg[cat_col].astype(str).to_numpy()
+    scores = agg[value_col].to_numpy()
+    horizontal = orientation == "h"
+    fig = go.Figure(go.Bar(
+        x=scores if horizontal else categories,
+        y=categories if horizontal else scores,
+        orientation=orientation,
+        text=None if text is None else agg[text].to_numpy(),
+        marker=marker
+    ))
+    cat_axis, value_axis = ("yaxis", "xaxis") if horizontal else ("xaxis", "yaxis")
+    fig.update_layout(
+        title=title,
+        **{cat_axis: dict(title=cat_col, type="category"), value_axis: dict(title=value_title, hoverformat=".2f" if value_col == 'avg_score' else None)}
+    )
+    return fig
+
+def score_box(stats, cat_col, title):
+    # One prepared box per row of a box_stats() result, each its own trace so
+    # groups keep separate colours and legend entries as with px.box(color=...).
+    # Only box_stats() is cached; like score_bar(), the figure is cheaper to
+    # build than to unpickle. The outlier values go in as the box's sample
+    # points, which Plotly draws beyond the whiskers.
+    fig = go.Figure([
+        go.Box(
+            name=str(row[cat_col]), x=[str(row[cat_col])],
+            q1=[row['q1']], median=[row['median']], q3=[row['q3']],
+            lowerfence=[row['lowerfence']], upperfence=[row['upperfence']],
+            y=[row['outliers']], boxpoints="outliers"
+        )
+        for row in stats.to_dict('records')
+    ])
+    fig.update_layout(
+        title=title,
+        xaxis=dict(title=cat_col, type="category"),
+        yaxis=dict(title=OUTCOME)
+    )
+    return fig
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def region_choropleth(map_data, color_col, color_by, _geojson):
+    # Building the choropleth walks the whole GeoJSON, so the finished figure
+    # is kept per (aggregate, colouring) and shared read-only across reruns.
+    # Each figure carries its own copy of the outlines, hence the small cap.
+    # The GeoJSON is the single cached load_geojson() object, so it is not hashed.
+    # choropleth_map draws the regions with WebGL (MapLibre) rather than SVG;
+    # the blank "white-bg" style needs no tile server, like the old geo view.
+    center, zoom = map_view(_geojson, set(map_data['region_en'].dropna()))
+    fig = px.choropleth_map(
+        map_data,
+        geojson=_geojson,
+        featureidkey="properties.name",  # Link to English name in GeoJSON
+        locations='region_en',          # Use the mapped English names for location
+        color=color_col,
+        color_continuous_scale="Tealgrn",
+        hover_name='Область',           # Show Russian name in tooltip
+        hover_data={'avg_score': ':.2f', 'count': True},
+        title=f"{color_by} по областям",
+        map_style="white-bg",
+        center=center,
+        zoom=zoom
+    )
+    fig.update_layout(margin={"r":0,"t":40,"l":0,"b":0})
+    return fig
+
+filters = ()
 
 # --- Subject Filter ---
 if "Предмет" in df.columns:
-    subjects = sorted(df['Предмет'].dropna().unique())
+    subjects = filter_options(df, 'Предмет')
     selected_subjects = st.sidebar.multiselect(
         'Фильтр по предмету:',
         options=subjects,
         default=subjects
     )
-    if not selected_subjects:
-        df_filtered = pd.DataFrame(columns=df.columns)
-    else:
-        df_filtered = df_filtered[df_filtered['Предмет'].isin(selected_subjects)]
+    # Everything selected (the default) is not a filter at all
+    if len(selected_subjects) < len(subjects):
+        filters += (("Предмет", tuple(selected_subjects)),)
+
+df_filtered = apply_filters(df, filters)
 
 # --- Position Filter (cascading) ---
 if "Должность" in df.columns and not df_filtered.empty:
-    positions = sorted(df_filtered['Должность'].dropna().unique())
+    positions = filter_options(df, 'Должность', filters)
     selected_positions = st.sidebar.multiselect(
         'Фильтр по должности:',
         options=positions,
         default=positions
     )
-    if not selected_positions:
-        df_filtered = pd.DataFrame(columns=df.columns)
-    else:
-        df_filtered = df_filtered[df_filtered['Должность'].isin(selected_positions)]
+    if len(selected_positions) < len(positions):
+        filters += (("Должность", tuple(selected_positions)),)
+        df_filtered = apply_filters(df, filters)
+
+# Map page sections run as fragments: switching the colouring or the drilled-down
+# region reruns only that section instead of the whole script.
+@st.fragment
+def region_map_section(filters, geojson_regions):
+    # --- MAP CHART ---
+    st.header("Карта по областям")
+    color_by = st.radio(
+        "Раскрасить карту по:",
+        ('Средний балл', 'Количество записей'),
+        horizontal=True
+    )
+
+    map_data = agg_by(df, filters, ('Область',))
+
+    # Create a new column with English names for mapping; on a categorical
+    # column .map() translates the categories, not every row
+    map_data['region_en'] = map_data['Область'].map(REGION_MAP)
+
+    # Check for regions that were not mapped
+    unmapped_regions = map_data[map_data['region_en'].isna()]['Область'].tolist()
+    if unmapped_regions:
+        st.warning(f"Не удалось сопоставить следующие регионы из данных: {unmapped_regions}. Проверьте словарь `REGION_MAP` в коде.")
+
+    color_map_col = 'avg_score' if color_by == 'Средний балл' else 'count'
+
+    fig_map = region_choropleth(map_data, color_map_col, color_by, geojson_regions)
+    st.plotly_chart(fig_map, use_container_width=True)
+
+@st.fragment
+def district_section(filters):
+    # --- DISTRICT (РАЙОН) DRILL-DOWN ---
+    st.markdown("---")
+    st.header("Детализация по районам")
+
+    available_regions = filter_options(df, 'Область', filters)
+    selected_region = st.selectbox(
+        "Выберите область для детализации:",
+        options=available_regions,
+        index=None,
+        placeholder="Выберите область..."
+    )
+
+    if selected_region:
+        if 'Район' in df.columns:
+            # One cached aggregate serves the drilldown of every region
+            district_agg = agg_by(df, filters, ('Область', 'Район'))
+            district_agg = district_agg[district_agg['Область'] == selected_region]
+            if not district_agg.empty:
+                district_agg = district_agg.sort_values('avg_score', ascending=True)
+
+                fig_district = score_bar(
+                    district_agg, 'Район',
+                    title=f"Средний балл по районам: {selected_region}",
+                    value_title='Средний балл',
+                    orientation='h',
+                    text='avg_score'
+                )
+                fig_district.update_traces(texttemplate='%{text:.2f}', textposition='outside')
+                st.plotly_chart(fig_district, use_container_width=True)
+            else:
+                st.info(f"В области '{selected_region}' нет данных по районам для отображения.")
+        else:
+            st.warning("Столбец 'Район' не найден в данных для детализации.")
 
 # =============================================================================
 # PAGE 1: Основной анализ
@@ -73,13 +484,14 @@ if page == "Основной анализ":
         st.markdown("Ниже приведены ключевые статистики по полу, возрасту и областям.")
         # --- OVERALL STATS ---
         st.header("Общая статистика")
+        n_records, mean_score, median_score = outcome_summary(df, filters)
         c1, c2, c3 = st.columns(3)
         with c1:
-            st.metric("Всего записей", f"{len(df_filtered):,}")
+            st.metric("Всего записей", f"{n_records:,}")
         with c2:
-            st.metric("Средний балл", f"{df_filtered[OUTCOME].mean():.2f}")
+            st.metric("Средний балл", f"{mean_score:.2f}")
         with c3:
-            st.metric("Медианный балл", f"{df_filtered[OUTCOME].median():.2f}")
+            st.metric("Медианный балл", f"{median_score:.2f}")
         st.markdown("---")
 
         # --- GENDER STATS ---
@@ -87,85 +499,64 @@ if page == "Основной анализ":
             st.header("Статистика по полу")
             c1, c2 = st.columns(2)
             with c1:
-                st.plotly_chart(px.box(df_filtered, x="Пол", y=OUTCOME, color="Пол", title="Распределение итогового балла по полу"), use_container_width=True)
+                st.plotly_chart(score_box(box_stats(df, filters, "Пол"), "Пол", "Распределение итогового балла по полу"), use_container_width=True)
             with c2:
-                agg_gender = df_filtered.groupby("Пол").agg(
-                    avg_score=(OUTCOME, 'mean'),
-                    count=(OUTCOME, 'size')
-                ).reset_index()
-                agg_gender['bar_text'] = agg_gender.apply(
-                    lambda row: f"Ср. балл: {row['avg_score']:.2f}<br>Кол-во: {int(row['count'])}",
-                    axis=1
-                )
+                agg_gender = agg_by(df, filters, ("Пол",))
+                agg_gender['bar_text'] = bar_labels(agg_gender)
 
-                fig_gender = px.bar(
-                    agg_gender,
-                    x="Пол",
-                    y='avg_score',
-                    color="Пол",
+                teal = px.colors.sequential.Teal
+                fig_gender = score_bar(
+                    agg_gender, "Пол",
                     title="Средний итоговый балл по полу",
+                    value_title="Средний " + OUTCOME,
                     text='bar_text',
-                    color_discrete_sequence=px.colors.sequential.Teal
+                    marker=dict(color=[teal[i % len(teal)] for i in range(len(agg_gender))])
                 )
                 fig_gender.update_traces(texttemplate='%{text}', textposition='inside')
-                fig_gender.update_layout(yaxis_title="Средний " + OUTCOME)
                 st.plotly_chart(fig_gender, use_container_width=True)
 
         # --- AGE STATS ---
         if "Возрастная группа" in df_filtered.columns:
             st.header("Статистика по возрасту")
-            age_group_order = ['<25', '25-30', '30-35', '35-40', '40-45', '45-50', '50-55', '55-60', '>60']
-            df_filtered['Возрастная группа'] = pd.Categorical(df_filtered['Возрастная группа'], categories=age_group_order, ordered=True)
             c1, c2 = st.columns(2)
             with c1:
-                st.plotly_chart(px.box(df_filtered, x="Возрастная группа", y=OUTCOME, color="Возрастная группа", title="Распределение итогового балла по возрастным группам"), use_container_width=True)
+                st.plotly_chart(score_box(box_stats(df, filters, "Возрастная группа"), "Возрастная группа", "Распределение итогового балла по возрастным группам"), use_container_width=True)
             with c2:
-                agg_agegrp = df_filtered.groupby("Возрастная группа", observed=False).agg(
-                    avg_score=(OUTCOME, 'mean'),
-                    count=(OUTCOME, 'size')
-                ).reset_index()
-                agg_agegrp['bar_text'] = agg_agegrp.apply(
-                    lambda row: f"Ср. балл: {row['avg_score']:.2f}<br>Кол-во: {int(row['count'])}",
-                    axis=1
-                )
+                agg_agegrp = agg_by(df, filters, ("Возрастная группа",))
+                agg_agegrp['bar_text'] = bar_labels(agg_agegrp)
 
-                fig_agegrp = px.bar(
-                    agg_agegrp,
-                    x="Возрастная группа",
-                    y='avg_score',
+                fig_agegrp = score_bar(
+                    agg_agegrp, "Возрастная группа",
                     title="Средний итоговый балл по возрастным группам",
-                    color='avg_score',
+                    value_title="Средний " + OUTCOME,
                     text='bar_text',
-                    color_continuous_scale="Tealgrn"
+                    marker=dict(color=agg_agegrp['avg_score'].to_numpy(), colorscale="Tealgrn", showscale=True)
                 )
                 fig_agegrp.update_traces(texttemplate='%{text}', textposition='inside')
-                fig_agegrp.update_layout(yaxis_title="Средний " + OUTCOME)
                 st.plotly_chart(fig_agegrp, use_container_width=True)
 
         # --- REGION STATS ---
         if "Область" in df_filtered.columns:
             st.header("Статистика по областям")
-            all_regions = pd.DataFrame({"Область": sorted(df["Область"].unique())})
-            
-            agg_obl = df_filtered.groupby("Область").agg(
-                avg_score=(OUTCOME, 'mean'),
-                count=(OUTCOME, 'size')
-            ).reset_index()
-            
-            avg_obl_full = all_regions.merge(agg_obl, on="Область", how="left")
-            avg_obl_full['avg_score'] = avg_obl_full['avg_score'].round(2)
-            avg_obl_full['bar_text'] = avg_obl_full.apply(
-                lambda row: f"Ср. балл: {row['avg_score']}<br>Кол-во: {int(row['count'])}" if pd.notna(row['count']) else "",
-                axis=1
+            # Reindex on the categories so regions outside the selection still
+            # get an (empty) bar
+            agg_obl = agg_by(df, filters, ("Область",))
+            avg_obl_full = (
+                agg_obl.set_index("Область")
+                .reindex(df["Область"].cat.categories)
+                .rename_axis("Область")
+                .reset_index()
             )
+            avg_obl_full['bar_text'] = bar_labels(avg_obl_full)
 
-            fig = px.bar(
-                avg_obl_full.sort_values("avg_score", na_position="first"),
-                x="avg_score", y="Область", orientation="h",
-                color="avg_score", color_continuous_scale="Tealgrn",
-                text='bar_text',
+            avg_obl_full = avg_obl_full.sort_values("avg_score", na_position="first")
+            fig = score_bar(
+                avg_obl_full, "Область",
                 title="Средний итоговый балл по областям",
-                labels={'avg_score': 'Средний итоговый балл', 'Область': 'Область'}
+                value_title="Средний итоговый балл",
+                orientation="h",
+                text='bar_text',
+                marker=dict(color=avg_obl_full['avg_score'].to_numpy(), colorscale="Tealgrn", showscale=True)
             )
             fig.update_traces(texttemplate='%{text}', textposition='inside')
             fig.update_layout(uniformtext_minsize=8, uniformtext_mode='hide')
@@ -185,28 +576,39 @@ elif page == "Детальный анализ":
             if col in df_filtered.columns:
                 st.markdown("---")
                 st.header(f"Анализ по '{col}'")
-                df_cat = df_filtered.dropna(subset=[col])
-                if df_cat.empty:
+                # Mean and count per value come from one cached pass over the
+                # selection, shared by both bar charts below; rows without a
+                # value are left out of it.
+                cat_agg = agg_by(df, filters, (col,))
+                if cat_agg.empty:
                     st.warning(f"Нет данных для анализа по '{col}' с учетом текущих фильтров.")
                     continue
+                avg_cat = cat_agg.sort_values('avg_score', ascending=False)
+                fig_bar_avg = score_bar(
+                    avg_cat, col,
+                    title=f"Средний балл по '{col}'",
+                    value_title=OUTCOME,
+                    marker=dict(color=avg_cat['avg_score'].to_numpy(), colorscale="Tealgrn")
+                )
+                fig_bar_avg.update_xaxes(tickangle=-90)
                 if col == "Категория":
+                    # Категория also gets a box plot, next to its mean bars
                     c1, c2 = st.columns(2)
                     with c1:
-                        fig_box = px.box(df_cat, x=col, y=OUTCOME, color=col, title=f"Распределение баллов по '{col}'")
+                        fig_box = score_box(box_stats(df, filters, col), col, f"Распределение баллов по '{col}'")
                         st.plotly_chart(fig_box, use_container_width=True)
                     with c2:
-                        avg_cat = df_cat.groupby(col)[OUTCOME].mean().round(2).reset_index().sort_values(OUTCOME, ascending=False)
-                        fig_bar_avg = px.bar(avg_cat, x=col, y=OUTCOME, color=col, title=f"Средний балл по '{col}'")
-                        fig_bar_avg.update_xaxes(tickangle=-90)
                         st.plotly_chart(fig_bar_avg, use_container_width=True)
                 else:
-                    avg_cat = df_cat.groupby(col)[OUTCOME].mean().round(2).reset_index().sort_values(OUTCOME, ascending=False)
-                    fig_bar_avg = px.bar(avg_cat, x=col, y=OUTCOME, color=col, title=f"Средний балл по '{col}'")
-                    fig_bar_avg.update_xaxes(tickangle=-90)
                     st.plotly_chart(fig_bar_avg, use_container_width=True)
-                counts = df_cat[col].value_counts().reset_index()
-                counts.columns = [col, 'count']
-                fig_bar_count = px.bar(counts, x=col, y='count', color=col, title=f"Количество cлушателей по '{col}'")
+                counts = cat_agg.sort_values('count', ascending=False, kind='stable')
+                fig_bar_count = score_bar(
+                    counts, col,
+                    title=f"Количество cлушателей по '{col}'",
+                    value_title='count',
+                    marker=dict(color=counts['count'].to_numpy(), colorscale="Tealgrn"),
+                    value_col='count'
+                )
                 fig_bar_count.update_xaxes(tickangle=-90)
                 st.plotly_chart(fig_bar_count, use_container_width=True)
             else:
@@ -222,111 +624,12 @@ elif page == "Карта":
         st.warning("Нет данных, соответствующих выбранным фильтрам.")
     else:
         try:
-            # Load the raw GeoJSON file with English names
-            with open("kz.json", "r", encoding="utf-8") as f:
-                geojson_regions = json.load(f)
+            # GeoJSON with English region names
+            geojson_regions = load_geojson()
         except FileNotFoundError:
             st.error("Файл 'kz.json' не найден. Пожалуйста, убедитесь, что он находится в той же папке, что и app.py.")
             st.stop()
 
-        # --- MAPPING DICTIONARY ---
-        # Maps Russian names from DataFrame to English names in GeoJSON properties
-        region_map = {
-            'Акмолинская область': 'Akmola',
-            'Актюбинская область': 'Aktobe',
-            'Алматинская область': 'Almaty',
-            'г.Алматы': 'Almaty (city)',
-            'Атырауская область': 'Atyrau',
-            'Восточно-Казахстанская область': 'East Kazakhstan',
-            'Жамбылская область': 'Jambyl',
-            'Западно-Казахстанская область': 'West Kazakhstan',
-            'Карагандинская область': 'Karaganda',
-            'Костанайская область': 'Kostanay',
-            'Кызылординская область': 'Kyzylorda',
-            'Мангистауская область': 'Mangystau',
-            'Павлодарская область': 'Pavlodar',
-            'Северо-Казахстанская область': 'North Kazakhstan',
-            'Туркестанская область': 'Turkestan',
-            'г.Астана': 'Astana',
-            'г.Шымкент': 'Shymkent (city)',
-            'область Жетісу':'Jetisu',
-            'область Абай':'Abai',
-            'область Ұлытау':'Ulytau',
-        }
-
-        # --- MAP CHART ---
-        st.header("Карта по областям")
-        color_by = st.radio(
-            "Раскрасить карту по:",
-            ('Средний балл', 'Количество записей'),
-            horizontal=True
-        )
-
-        map_data = df_filtered.groupby('Область').agg(
-            avg_score=(OUTCOME, 'mean'),
-            count=(OUTCOME, 'size')
-        ).reset_index()
-
-        # Create a new column with English names for mapping
-        map_data['region_en'] = map_data['Область'].map(region_map)
-
-        # Check for regions that were not mapped
-        unmapped_regions = map_data[map_data['region_en'].isna()]['Область'].tolist()
-        if unmapped_regions:
-            st.warning(f"Не удалось сопоставить следующие регионы из данных: {unmapped_regions}. Проверьте словарь `region_map` в коде.")
-
-        color_map_col = 'avg_score' if color_by == 'Средний балл' else 'count'
-
-        fig_map = px.choropleth(
-            map_data,
-            geojson=geojson_regions,
-            featureidkey="properties.name",  # Link to English name in GeoJSON
-            locations='region_en',          # Use the mapped English names for location
-            color=color_map_col,
-            color_continuous_scale="Tealgrn",
-            hover_name='Область',           # Show Russian name in tooltip
-            hover_data={'avg_score': ':.2f', 'count': True},
-            title=f"{color_by} по областям",
-            scope="asia"
-        )
-        fig_map.update_geos(fitbounds="locations", visible=False)
-        fig_map.update_layout(margin={"r":0,"t":40,"l":0,"b":0})
-        st.plotly_chart(fig_map, use_container_width=True)
-
-        # --- DISTRICT (РАЙОН) DRILL-DOWN ---
-        st.markdown("---")
-        st.header("Детализация по районам")
-
-        available_regions = sorted(df_filtered['Область'].dropna().unique())
-        selected_region = st.selectbox(
-            "Выберите область для детализации:",
-            options=available_regions,
-            index=None,
-            placeholder="Выберите область..."
-        )
-
-        if selected_region:
-            if 'Район' in df_filtered.columns:
-                district_data = df_filtered[df_filtered['Область'] == selected_region]
-                if not district_data['Район'].dropna().empty:
-                    district_agg = district_data.groupby('Район').agg(
-                        avg_score=(OUTCOME, 'mean'),
-                        count=(OUTCOME, 'size')
-                    ).round(2).reset_index().sort_values('avg_score', ascending=True)
-
-                    fig_district = px.bar(
-                        district_agg,
-                        x='avg_score',
-                        y='Район',
-                        orientation='h',
-                        title=f"Средний балл по районам: {selected_region}",
-                        labels={'avg_score': 'Средний балл', 'Район': 'Район'},
-                        text='avg_score'
-                    )
-                    fig_district.update_traces(textposition='outside')
-                    st.plotly_chart(fig_district, use_container_width=True)
-                else:
-                    st.info(f"В области '{selected_region}' нет данных по районам для отображения.")
-            else:
-                st.warning("Столбец 'Район' не найден в данных для детализации.")
+        region_map_section(filters, geojson_regions)
+        district_section(filters)
 